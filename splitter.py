@@ -3,27 +3,54 @@
 # Import libraries needed for application to work
 
 import argparse
+import concurrent.futures
+import fcntl
+import hashlib
 import shutil
 import gi
-import gzip
 import librepo
 import hawkey
 import tempfile
 import os
+import pickle
 import subprocess
 import sys
+import time
 
 # Look for a specific version of modulemd. The 1.x series does not
 # have the tools we need.
 try:
     gi.require_version('Modulemd', '2.0')
-    from gi.repository import Modulemd
+    from gi.repository import GLib, Modulemd
 except:
     print("We require newer vesions of modulemd than installed..")
     sys.exit(0)
     
 mmd = Modulemd
 
+# Used when libmodulemd cannot read compressed YAML itself. isal's
+# igzip is a faster drop-in for the gzip module.
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+# ioctl request number for cloning a file (linux/fs.h).
+FICLONE = 0x40049409
+
+# Where parsed repositories are cached between runs. An empty
+# XDG_CACHE_HOME means unset.
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'grobisplitter')
+
+# Cache entries not used for this many seconds are removed.
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+# Bump this whenever the structure or contents of parse_repository's
+# result change, so results cached by older code are not reused.
+CACHE_VERSION = 1
+
 # This code is from Stephen Gallagher to make my other caveman code
 # less icky.
 def _get_latest_streams (mymod, stream):
@@ -38,6 +65,39 @@ def _get_latest_streams (mymod, stream):
     
     return latest_streams
     
+def _get_module_index(filename):
+    """
+    Load the module metadata into a ModuleIndex. libmodulemd 2.8 and
+    later (built with rpmio) read compressed YAML themselves. Older
+    versions cannot, so decompress it ourselves when that fails.
+    Returns the ModuleIndex.
+    """
+    idx = mmd.ModuleIndex()
+    try:
+        res, failures = idx.update_from_file(filename, True)
+    except GLib.Error:
+        if not filename.endswith('.gz'):
+            raise
+        idx = mmd.ModuleIndex()
+        with gzip.open(filename, 'rb') as gzf:
+            mmdcts = gzf.read().decode('utf-8')
+        res, failures = idx.update_from_string(mmdcts, True)
+    if len(failures) != 0:
+        raise Exception("YAML FAILURE: FAILURES: %s" % failures)
+    if not res:
+        raise Exception("YAML FAILURE: res != True")
+    return idx
+
+def _upgrade_streams(idx):
+    """
+    Make sure every stream in the module index is at least v2. The
+    index tracks the stream metadata version it holds, so the upgrade
+    walk is skipped when the metadata is already new enough.
+    Returns None
+    """
+    if idx.get_stream_mdversion() < 2:
+        idx.upgrade_streams(2)
+
 def _get_repoinfo(directory):
     """
     A function which goes into the given directory and sets up the
@@ -72,58 +132,46 @@ def _get_hawkey_sack(repo_info):
 def _get_filelist(package_sack):
     """
     Determine the file locations of all packages in the sack. Use the
-    package-name-epoch-version-release-arch as the key.
-    Returns a dictionary.
+    package-name-epoch-version-release-arch as the key. The same pass
+    also collects every location, since a NEVRA may be present at more
+    than one location and only the last of those ends up in the dict.
+    Returns a dictionary and a set of all file locations.
     """
     pkg_list = {}
+    locations = set()
     for pkg in hawkey.Query(package_sack):
-        nevr="%s-%s:%s-%s.%s"% (pkg.name,pkg.epoch,pkg.version,pkg.release,pkg.arch)
+        nevr = f"{pkg.name}-{pkg.epoch}:{pkg.version}-{pkg.release}.{pkg.arch}"
         pkg_list[nevr] = pkg.location
-    return pkg_list
+        locations.add(pkg.location)
+    return pkg_list, locations
 
-def _parse_repository_non_modular(package_sack, repo_info, modpkgset):
+def _parse_repository_non_modular(locations, modpkgset):
     """
     Simple routine to go through a repo, and figure out which packages
     are not in any module. Add the file locations for those packages
-    so we can link to them.
+    so we can link to them. The locations were already gathered with
+    the filelist, so there is no need to query the sack again.
     Returns a set of file locations.
     """
-    sack = package_sack
-    pkgs = set()
+    return locations - modpkgset
 
-    for pkg in hawkey.Query(sack):
-        if pkg.location in modpkgset:
-            continue
-        pkgs.add(pkg.location)
-    return pkgs
-
-def _parse_repository_modular(repo_info,package_sack):
+def _parse_repository_modular(repo_info, pkgs_list):
     """
     Returns a dictionary of packages indexed by the modules they are
     contained in.
     """
     cts = {}
-    idx = mmd.ModuleIndex()
-    with gzip.GzipFile(filename=repo_info['modules'], mode='r') as gzf:
-        mmdcts = gzf.read().decode('utf-8')
-        res, failures = idx.update_from_string(mmdcts, True)
-        if len(failures) != 0:
-            raise Exception("YAML FAILURE: FAILURES: %s" % failures)
-        if not res:
-            raise Exception("YAML FAILURE: res != True")
+    idx = _get_module_index(repo_info['modules'])
 
-    pkgs_list = _get_filelist(package_sack)
-    idx.upgrade_streams(2)
+    _upgrade_streams(idx)
     for modname in idx.get_module_names():
         mod = idx.get_module(modname)
         for stream in mod.get_all_streams():
-            templ = list()
-            for pkg in stream.get_rpm_artifacts():
-                if pkg in pkgs_list:
-                    templ.append(pkgs_list[pkg])
-                else:
-                    continue
-            cts[stream.get_NSVCA()] = templ
+            # Keep the artifact order so the output is the same run to
+            # run.
+            cts[stream.get_NSVCA()] = [pkgs_list[a]
+                                       for a in stream.get_rpm_artifacts()
+                                       if a in pkgs_list]
                 
     return cts
 
@@ -132,7 +180,7 @@ def _get_modular_pkgset(mod):
     """
     Takes a module and goes through the moduleset to determine which
     packages are inside it. 
-    Returns a list of packages
+    Returns a set of packages
     """
     pkgs = set()
 
@@ -140,12 +188,41 @@ def _get_modular_pkgset(mod):
         for pkg in modcts:
             pkgs.add(pkg)
 
-    return list(pkgs)
+    return pkgs
 
-def _perform_action(src, dst, action):
+def _reflink(src, dst):
+    """
+    Clone src to dst sharing the data blocks (FICLONE) where the
+    filesystem supports it. Otherwise try to have the kernel do the copy
+    with copy_file_range and as a last resort fall back to shutil.copy.
+    Returns None
     """
-    Performs either a copy, hardlink or symlink of the file src to the
-    file destination.
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                                remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except (AttributeError, OSError):
+                # copy_file_range may have copied part of the file before
+                # failing, so start again from the beginning of both.
+                fdst.seek(0)
+                fdst.truncate(0)
+                fsrc.seek(0)
+                shutil.copyfileobj(fsrc, fdst)
+    shutil.copymode(src, dst)
+
+def _perform_action(src, dst, action, src_dir_fd=None, dst_dir_fd=None):
+    """
+    Performs either a copy, reflink, hardlink or symlink of the file src
+    to the file destination. For hardlink and symlink, src and dst may
+    be relative to the open directories src_dir_fd and dst_dir_fd.
     Returns None
     """
     if action == 'copy':
@@ -155,24 +232,70 @@ def _perform_action(src, dst, action):
             # Missing files are acceptable: they're already checked before
             # this by validate_filenames.
             pass
+    elif action == 'reflink':
+        try:
+            _reflink(src, dst)
+        except FileNotFoundError:
+            # Same as copy: validate_filenames has already checked.
+            pass
     elif action == 'hardlink':
-        os.link(src, dst)
+        os.link(src, dst, src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
     elif action == 'symlink':
-        os.symlink(src, dst)
+        os.symlink(src, dst, dir_fd=dst_dir_fd)
 
-def validate_filenames(directory, repoinfo):
+def _find_existing(directory, pkgs):
+    """
+    Work out which of the package paths exist under directory, listing
+    each directory they live in once rather than stat'ing every file.
+    Returns a set of the normalised paths which exist.
+    """
+    bydir = {}
+    for pkg in pkgs:
+        pkg = os.path.normpath(pkg)
+        bydir.setdefault(os.path.dirname(pkg), set()).add(pkg)
+
+    found = set()
+    for sub, wanted in bydir.items():
+        try:
+            # Opening by path follows symlinked directories (e.g.
+            # Packages -> ../...) just like os.path.exists does.
+            with os.scandir(os.path.join(directory, sub)) as it:
+                for entry in it:
+                    path = os.path.join(sub, entry.name)
+                    if path not in wanted:
+                        continue
+                    # A dangling symlink counts as missing.
+                    if entry.is_symlink() and not os.path.exists(entry.path):
+                        continue
+                    found.add(path)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        except PermissionError:
+            # We may be able to reach files in a directory we cannot
+            # list, so check those packages one at a time.
+            found.update(p for p in wanted
+                         if os.path.exists(os.path.join(directory, p)))
+    return found
+
+def validate_filenames(directory, repoinfo, early_exit=True):
     """
     Take a directory and repository information. Test each file in
     repository to exist in said module. This stops us when dealing
-    with broken repositories or missing modules.
+    with broken repositories or missing modules. With early_exit we
+    stop at the first missing file, otherwise every one is reported.
     Returns True if no problems found. False otherwise.
     """
+    fileset = _find_existing(
+        directory, (pkg for pkgs in repoinfo.values() for pkg in pkgs))
+
     isok = True
     for modname in repoinfo:
         for pkg in repoinfo[modname]:
-            if not os.path.exists(os.path.join(directory, pkg)):
+            if os.path.normpath(pkg) not in fileset:
                 isok = False
                 print("Path %s from mod %s did not exist" % (pkg, modname))
+                if early_exit:
+                    return False
     return isok
 
 
@@ -189,16 +312,9 @@ def get_default_modules(directory):
     contents = set()
     if 'modules' not in repo_info:
         return contents
-    idx = mmd.ModuleIndex()
-    with gzip.GzipFile(filename=repo_info['modules'], mode='r') as gzf:
-        mmdcts = gzf.read().decode('utf-8')
-        res, failures = idx.update_from_string(mmdcts, True)
-        if len(failures) != 0:
-            raise Exception("YAML FAILURE: FAILURES: %s" % failures)
-        if not res:
-            raise Exception("YAML FAILURE: res != True")
+    idx = _get_module_index(repo_info['modules'])
 
-    idx.upgrade_streams(2)
+    _upgrade_streams(idx)
 
     # OK this is cave-man no-sleep programming. I expect there is a
     # better way to do this that would be a lot better. However after
@@ -273,33 +389,83 @@ def get_default_modules(directory):
 
 
 def perform_split(repos, args, def_modules):
-    for modname in repos:
-        if args.only_defaults and modname not in def_modules:
-            continue
-        
-        targetdir = os.path.join(args.target, modname)
-        os.mkdir(targetdir)
-
-        for pkg in repos[modname]:
-            _, pkgfile = os.path.split(pkg)
-            _perform_action(
-                os.path.join(args.repository, pkg),
-                os.path.join(targetdir, pkgfile),
-                args.action)
+    """
+    Create a directory per module under the target and populate it
+    with the module's packages using the requested action.
+    Returns None
+    """
+    use_fds = args.action in ('hardlink', 'symlink')
+    repo_fd = None
+    target_fd = None
+    dir_fds = []
+    tasks = []
+    try:
+        if args.action == 'hardlink':
+            repo_fd = os.open(args.repository, os.O_RDONLY | os.O_DIRECTORY)
+        target_fd = os.open(args.target, os.O_RDONLY | os.O_DIRECTORY)
+        for modname in repos:
+            if args.only_defaults and modname not in def_modules:
+                continue
+
+            targetdir = os.path.join(args.target, modname)
+            os.mkdir(modname, dir_fd=target_fd)
+            td_fd = None
+            if use_fds:
+                td_fd = os.open(modname, os.O_RDONLY | os.O_DIRECTORY,
+                                dir_fd=target_fd)
+                dir_fds.append(td_fd)
+
+            for pkg in repos[modname]:
+                _, pkgfile = os.path.split(pkg)
+                if repo_fd is not None:
+                    src = pkg
+                else:
+                    src = os.path.join(args.repository, pkg)
+                if td_fd is not None:
+                    dst = pkgfile
+                else:
+                    dst = os.path.join(targetdir, pkgfile)
+                tasks.append((src, dst, td_fd))
+
+        workers = min(32, (os.cpu_count() or 1) * 4)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+            # Drain the iterator so any exception in a worker is raised here.
+            for _ in ex.map(lambda t: _perform_action(t[0], t[1], args.action,
+                                                      src_dir_fd=repo_fd,
+                                                      dst_dir_fd=t[2]),
+                            tasks):
+                pass
+    finally:
+        for fd in dir_fds:
+            os.close(fd)
+        if target_fd is not None:
+            os.close(target_fd)
+        if repo_fd is not None:
+            os.close(repo_fd)
 
 
 def create_repos(target, repos,def_modules, only_defaults):
     """
     Routine to create repositories. Input is target directory and a
     list of repositories.
+    The createrepo_c runs are independent so several are launched at
+    once, each limited to a single worker to avoid oversubscription.
     Returns None
     """
+    cmds = []
     for modname in repos:
         if only_defaults and modname not in def_modules:
             continue
-        subprocess.run([
+        cmds.append([
             'createrepo_c', os.path.join(target, modname),
-            '--no-database'])
+            '--no-database', '--workers=1'])
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count()) as ex:
+        futures = [ex.submit(subprocess.run, cmd, check=True)
+                   for cmd in cmds]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 
 def parse_args():
@@ -310,11 +476,15 @@ def parse_args():
     parser = argparse.ArgumentParser(description='Split repositories up')
     parser.add_argument('repository', help='The repository to split')
     parser.add_argument('--action', help='Method to create split repos files',
-                        choices=('hardlink', 'symlink', 'copy'),
+                        choices=('hardlink', 'symlink', 'copy', 'reflink'),
                         default='hardlink')
     parser.add_argument('--target', help='Target directory for split repos')
     parser.add_argument('--skip-missing', help='Skip missing packages',
                         action='store_true', default=False)
+    parser.add_argument('--verbose', help='Report every missing package',
+                        action='store_true', default=False)
+    parser.add_argument('--no-cache', help='Do not cache parsed repositories',
+                        action='store_true', default=False)
     parser.add_argument('--create-repos', help='Create repository metadatas',
                         action='store_true', default=False)
     parser.add_argument('--only-defaults', help='Only output default modules',
@@ -337,37 +507,125 @@ def setup_target(args):
         else:
             os.mkdir(args.target)
 
-def parse_repository(directory):
+def _file_sha256(path):
+    """
+    Compute the SHA-256 of a file without reading it all into memory.
+    Returns the hex digest.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _get_cache_file(repo_info):
+    """
+    Work out the cache file for a repository. The key is made from the
+    cache format version and the repomd.xml and modules.yaml checksums,
+    so any change to the metadata or to the shape of the parsed result
+    gives a new key.
+    Returns a path.
+    """
+    key = "%d:%s" % (CACHE_VERSION, _file_sha256(repo_info['repomd']))
+    if 'modules' in repo_info:
+        key += _file_sha256(repo_info['modules'])
+    key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, "%s.pickle" % key)
+
+def _load_cache(cache_file):
+    """
+    Load a previously parsed repository from the cache.
+    Returns the dict or None if there is no usable cache entry.
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            mod = pickle.load(f)
+        # Mark the entry as recently used so it is not pruned.
+        os.utime(cache_file)
+        return mod
+    except Exception:
+        # A missing or damaged cache entry is not fatal, we just parse
+        # again.
+        return None
+
+def _prune_cache():
+    """
+    Remove cache entries which have not been used for CACHE_MAX_AGE,
+    so the cache does not keep growing with every new repository.
+    Returns None
+    """
+    cutoff = time.time() - CACHE_MAX_AGE
+    try:
+        with os.scandir(CACHE_DIR) as it:
+            for entry in it:
+                if (entry.name.endswith('.pickle')
+                        and entry.stat().st_mtime < cutoff):
+                    os.unlink(entry.path)
+    except OSError:
+        pass
+
+def _save_cache(cache_file, mod):
+    """
+    Store a parsed repository in the cache. The file is written to a
+    temporary name and moved into place so a reader never sees a
+    partial entry. Failures are ignored as the cache is only an aid.
+    Returns None
+    """
+    tmpname = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=CACHE_DIR, delete=False) as f:
+            tmpname = f.name
+            pickle.dump(mod, f)
+        os.replace(tmpname, cache_file)
+    except (OSError, pickle.PicklingError):
+        if tmpname is not None:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+
+def parse_repository(directory, use_cache=True):
     """
     Parse a specific directory, returning a dict with keys module NSVC's and
     values a list of package NVRs.
     The dict will also have a key "non_modular" for the non-modular packages.
+    Results are cached between runs unless use_cache is False.
     """
     directory = os.path.abspath(directory)
     repo_info = _get_repoinfo(directory)
 
+    # Reuse an earlier parse of the same metadata if we have one.
+    if use_cache:
+        cache_file = _get_cache_file(repo_info)
+        mod = _load_cache(cache_file)
+        if mod is not None:
+            return mod
+
     # Get the package sack and get a filelist of all packages.
     package_sack = _get_hawkey_sack(repo_info)
-    _get_filelist(package_sack)
+    pkgs_list, locations = _get_filelist(package_sack)
 
     # If we have a repository with no modules we do not want our
     # script to error out but just remake the repository with
     # everything in a known sack (aka non_modular).
      
     if 'modules' in repo_info:
-        mod = _parse_repository_modular(repo_info,package_sack)
+        mod = _parse_repository_modular(repo_info, pkgs_list)
         modpkgset = _get_modular_pkgset(mod)
     else:
         mod = dict()
         modpkgset = set()
 
-    non_modular = _parse_repository_non_modular(package_sack,repo_info, 
-                                  modpkgset) 
+    non_modular = _parse_repository_non_modular(locations, modpkgset)
     mod['non_modular'] = non_modular
 
     ## We should probably go through our default modules here and
     ## remove them from our mod. This would cut down some code paths.
 
+    if use_cache:
+        _save_cache(cache_file, mod)
+        _prune_cache()
     return mod
 
 def main():
@@ -377,7 +635,7 @@ def main():
     # Go through arguments and act on their values.
     setup_target(args)
 
-    repos = parse_repository(args.repository)
+    repos = parse_repository(args.repository, not args.no_cache)
 
     if args.only_defaults:
         def_modules = get_default_modules(args.repository)
@@ -386,7 +644,8 @@ def main():
     def_modules.add('non_modular')        
     
     if not args.skip_missing:
-        if not validate_filenames(args.repository, repos):
+        if not validate_filenames(args.repository, repos,
+                                  early_exit=not args.verbose):
             raise ValueError("Package files were missing!")
     if args.target:
         perform_split(repos, args, def_modules)